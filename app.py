@@ -3,6 +3,8 @@ import sqlite3
 import pandas as pd
 import re
 import altair as alt
+import json
+import numpy as np
 
 st.set_page_config(page_title="NYC History Archive", layout="wide")
 
@@ -38,19 +40,341 @@ st.markdown("""
 page = st.radio("Menu", ["Search Ledger", "Historical Analytics"], horizontal=True, label_visibility="collapsed")
 
 # --- DATABASE HELPERS ---
+DB_PATH = "nyc_history.db"
+
+# One shared read-only connection per server process; WAL + mmap let readers pull pages
+# straight from the mapped file instead of reopening it on every rerun.
+@st.cache_resource
 def get_db_connection():
-    return sqlite3.connect("nyc_history.db")
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+# Small aggregate results go straight from the cursor into a DataFrame, skipping
+# read_sql's per-column dtype sniffing
+def query_df(sql, params=()):
+    cur = get_db_connection().execute(sql, params)
+    return pd.DataFrame(cur.fetchall(), columns=[c[0] for c in cur.description])
+
+# --- SCHEMA MIGRATIONS ---
+# Applied in order against PRAGMA user_version, so each script runs once per database file.
+
+# Rewrites sort_key for the whole table. As a dense rank it can't be assigned per row, so rows
+# loaded after migration 5 (or re-sorted by an edit, see directory_sort_key_au) sit at NULL until
+# the next process start, when migrate_db renumbers everything: restart the app after each load.
+RENUMBER_SORT_KEY = """
+    UPDATE directory SET sort_key = ranked.k
+    FROM (SELECT rowid AS id, ROW_NUMBER() OVER (ORDER BY year, street_sort, house_sort, last_name, rowid) AS k FROM directory) AS ranked
+    WHERE directory.rowid = ranked.id;
+"""
+
+# Adds (d=1) or removes (d=-1) one directory row, `rec` being the trigger's new/old, from the
+# summary tables so they track later loads the way directory_fts does. The keys are normalised
+# from the raw columns: an AFTER INSERT trigger still sees occupation_norm/street_norm as NULL.
+def summary_delta_sql(rec, d):
+    sql = f"""
+        INSERT INTO directory_year_counts VALUES ({rec}.year, {rec}.is_high_quality, {d})
+            ON CONFLICT (year, is_high_quality) DO UPDATE SET cnt = cnt + excluded.cnt;
+        INSERT INTO occ_year_counts
+            SELECT {rec}.year, UPPER(TRIM({rec}.occupation)), {rec}.is_high_quality, UPPER(TRIM({rec}.occupation)) LIKE '%WIDOW%', {d}
+            WHERE {rec}.occupation != '' ON CONFLICT (year, Trade, is_high_quality) DO UPDATE SET Count = Count + excluded.Count;
+        INSERT INTO street_year_counts SELECT {rec}.year, UPPER(TRIM({rec}.street_sort)), {d}
+            WHERE {rec}.street_sort != 'zzzzz' ON CONFLICT (year, Street) DO UPDATE SET Count = Count + excluded.Count;
+    """
+    if d < 0:
+        sql += f"""
+        DELETE FROM directory_year_counts WHERE year = {rec}.year AND cnt = 0;
+        DELETE FROM occ_year_counts WHERE year = {rec}.year AND Count = 0;
+        DELETE FROM street_year_counts WHERE year = {rec}.year AND Count = 0;
+        """
+    return sql
+
+MIGRATIONS = [
+    # 1: trigram full-text index so substring filters stop scanning the whole table
+    """
+    CREATE VIRTUAL TABLE directory_fts USING fts5(
+        last_name, first_name, occupation, business_address, home_address,
+        content='directory', content_rowid='rowid', tokenize='trigram'
+    );
+    INSERT INTO directory_fts(directory_fts) VALUES ('rebuild');
+    CREATE TRIGGER directory_fts_ai AFTER INSERT ON directory BEGIN
+        INSERT INTO directory_fts(rowid, last_name, first_name, occupation, business_address, home_address)
+        VALUES (new.rowid, new.last_name, new.first_name, new.occupation, new.business_address, new.home_address);
+    END;
+    CREATE TRIGGER directory_fts_ad AFTER DELETE ON directory BEGIN
+        INSERT INTO directory_fts(directory_fts, rowid, last_name, first_name, occupation, business_address, home_address)
+        VALUES ('delete', old.rowid, old.last_name, old.first_name, old.occupation, old.business_address, old.home_address);
+    END;
+    CREATE TRIGGER directory_fts_au AFTER UPDATE OF last_name, first_name, occupation, business_address, home_address ON directory BEGIN
+        INSERT INTO directory_fts(directory_fts, rowid, last_name, first_name, occupation, business_address, home_address)
+        VALUES ('delete', old.rowid, old.last_name, old.first_name, old.occupation, old.business_address, old.home_address);
+        INSERT INTO directory_fts(rowid, last_name, first_name, occupation, business_address, home_address)
+        VALUES (new.rowid, new.last_name, new.first_name, new.occupation, new.business_address, new.home_address);
+    END;
+    """,
+    # 2: quality gate behind the filtered per-year record counts
+    """
+    CREATE INDEX idx_hq_year ON directory(is_high_quality, year);
+    """,
+    # 3: per-edition totals so unfiltered record counts never touch the directory table
+    """
+    CREATE TABLE directory_year_counts AS
+        SELECT year, is_high_quality, COUNT(*) AS cnt FROM directory GROUP BY year, is_high_quality;
+    CREATE UNIQUE INDEX idx_year_counts_key ON directory_year_counts(year, is_high_quality);
+    """,
+    # 4: surname-first search key; NOCASE on the column lets prefix LIKE use the index
+    """
+    ALTER TABLE directory ADD COLUMN name_search TEXT COLLATE NOCASE
+        GENERATED ALWAYS AS (lower(last_name || ' ' || first_name)) VIRTUAL;
+    CREATE INDEX idx_name ON directory(name_search);
+    """,
+    # 5: the ledger order (year, street_sort, house_sort, last_name, rowid) packed into one
+    # dense integer, so paging and ORDER BY walk a single indexed key
+    f"""
+    ALTER TABLE directory ADD COLUMN sort_key INTEGER;
+    {RENUMBER_SORT_KEY}
+    CREATE INDEX idx_research_sort_key ON directory(year, sort_key);
+    CREATE TRIGGER directory_sort_key_au AFTER UPDATE OF year, street_sort, house_sort, last_name ON directory BEGIN
+        UPDATE directory SET sort_key = NULL WHERE rowid = new.rowid;
+    END;
+    """,
+    # 6: the ledger's Address column, resolved once instead of per returned row. Stored rather than
+    # generated so idx_default_view can cover it; triggers fill it for rows loaded or edited later.
+    """
+    ALTER TABLE directory ADD COLUMN display_address TEXT;
+    UPDATE directory SET display_address = COALESCE(NULLIF(home_address, ''), business_address);
+    CREATE TRIGGER directory_display_address_ai AFTER INSERT ON directory BEGIN
+        UPDATE directory SET display_address = COALESCE(NULLIF(new.home_address, ''), new.business_address) WHERE rowid = new.rowid;
+    END;
+    CREATE TRIGGER directory_display_address_au AFTER UPDATE OF home_address, business_address ON directory BEGIN
+        UPDATE directory SET display_address = COALESCE(NULLIF(new.home_address, ''), new.business_address) WHERE rowid = new.rowid;
+    END;
+    """,
+    # 7: covering index for the default high-quality ledger, so pages are read from index pages alone;
+    # is_high_quality is repeated as a key column because the planner won't treat the index as
+    # covering for a column it only sees in the partial-index WHERE
+    """
+    CREATE INDEX idx_default_view ON directory(
+        year, sort_key, first_name, last_name, occupation, display_address, business_address, publisher, printed_page,
+        is_high_quality
+    ) WHERE is_high_quality = 1;
+    """,
+    # 8: pre-aggregated street counts behind the analytics page
+    """
+    CREATE TABLE street_year_counts AS
+        SELECT year, UPPER(TRIM(street_sort)) AS Street, COUNT(*) AS Count
+        FROM directory WHERE street_sort != 'zzzzz' GROUP BY year, Street;
+    CREATE UNIQUE INDEX idx_street_year_counts ON street_year_counts(year, Street);
+    """,
+    # 9: normalised occupation/street keys so grouping never calls UPPER(TRIM()) per row; stored so
+    # idx_occ_norm covers Trade Mapping, with triggers normalising rows loaded or edited later
+    """
+    ALTER TABLE directory ADD COLUMN occupation_norm TEXT;
+    ALTER TABLE directory ADD COLUMN street_norm TEXT;
+    UPDATE directory SET occupation_norm = UPPER(TRIM(occupation)), street_norm = UPPER(TRIM(street_sort));
+    CREATE INDEX idx_occ_norm ON directory(year, occupation_norm, street_norm);
+    CREATE TRIGGER directory_norm_ai AFTER INSERT ON directory BEGIN
+        UPDATE directory SET occupation_norm = UPPER(TRIM(new.occupation)), street_norm = UPPER(TRIM(new.street_sort)) WHERE rowid = new.rowid;
+    END;
+    CREATE TRIGGER directory_norm_au AFTER UPDATE OF occupation, street_sort ON directory BEGIN
+        UPDATE directory SET occupation_norm = UPPER(TRIM(new.occupation)), street_norm = UPPER(TRIM(new.street_sort)) WHERE rowid = new.rowid;
+    END;
+    """,
+    # 10: pre-aggregated occupation counts behind the analytics page, with widow entries flagged once
+    # instead of a leading-wildcard NOT LIKE on every chart query. ALTER TABLE can only add VIRTUAL
+    # generated columns; the flag is materialised in occ_year_counts.
+    """
+    ALTER TABLE directory ADD COLUMN is_widow INTEGER GENERATED ALWAYS AS (occupation_norm LIKE '%WIDOW%') VIRTUAL;
+    CREATE TABLE occ_year_counts AS
+        SELECT year, occupation_norm AS Trade, is_high_quality, is_widow, COUNT(*) AS Count
+        FROM directory WHERE occupation != '' GROUP BY year, occupation_norm, is_high_quality, is_widow;
+    CREATE UNIQUE INDEX idx_occ_year_counts_key ON occ_year_counts(year, Trade, is_high_quality);
+    CREATE INDEX idx_occ_year_counts ON occ_year_counts(year, is_high_quality, is_widow);
+    """,
+    # 11: keep the three summary tables current as rows are loaded, changed or removed, then
+    # gather planner statistics over the finished schema
+    f"""
+    CREATE TRIGGER directory_counts_ai AFTER INSERT ON directory BEGIN {summary_delta_sql("new", 1)} END;
+    CREATE TRIGGER directory_counts_ad AFTER DELETE ON directory BEGIN {summary_delta_sql("old", -1)} END;
+    CREATE TRIGGER directory_counts_au AFTER UPDATE OF year, is_high_quality, occupation, street_sort ON directory BEGIN
+        {summary_delta_sql("old", -1)} {summary_delta_sql("new", 1)}
+    END;
+    ANALYZE;
+    """,
+]
+
+@st.cache_resource
+def migrate_db():
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'directory'").fetchone():
+            return
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.executescript(f"BEGIN; {script} PRAGMA user_version = {i}; COMMIT;")
+        # A NULL sort_key (row loaded or re-sorted since the last start) would sort first and never pass the page cursor
+        if conn.execute("SELECT 1 FROM directory WHERE sort_key IS NULL LIMIT 1").fetchone():
+            conn.executescript(f"BEGIN; {RENUMBER_SORT_KEY} COMMIT;")
+    finally:
+        conn.close()
+
+# --- SEARCH HELPERS ---
+FTS_MIN_CHARS = 3  # the trigram tokenizer cannot match anything shorter
+LIKE_SPECIAL = re.compile(r"([\\%_])")  # escaped with "\" for LIKE ... ESCAPE '\'
+
+# Column-filtered FTS5 phrase; quotes are doubled so user input is matched literally.
+def fts_phrase(columns, text):
+    return "{" + " ".join(columns) + "} : \"" + text.replace('"', '""') + "\""
+
+
+# --- PAGINATION HELPERS ---
+# The cursor is the sort_key of the last row shown, so the next page is an index range scan
+# rather than an OFFSET that re-reads every earlier row.
+PAGE_SIZE = 200
+
+# --- CHART HELPERS ---
+LTTB_THRESHOLD = 300  # Vega's SVG renderer slows down linearly in mark count past this
+
+# The density chart's spec never changes, only its data, so it is built once per process
+@st.cache_resource
+def density_chart_template():
+    return alt.Chart().mark_line(color="#2c3e50", strokeWidth=2.5, point=alt.OverlayMarkDef(color="#2c3e50", size=50)).encode(
+        x=alt.X('year:O', title='Year', axis=alt.Axis(labelAngle=0, grid=True)),
+        y=alt.Y('count:Q', title='Records', scale=alt.Scale(zero=False, padding=10), axis=alt.Axis(grid=True)),
+        tooltip=['year', 'count']
+    ).properties(height=180, width='container').configure_axis(gridColor="#EAEAEA", gridDash=[2, 2], domain=False).configure_view(strokeWidth=0)
+
+# Largest-Triangle-Three-Buckets: keep one point per bucket, choosing the one that forms the
+# largest triangle with its neighbours, so peaks and valleys survive the downsampling.
+def lttb(df, x, y, n_out=LTTB_THRESHOLD):
+    if len(df) <= n_out or n_out < 3:
+        return df
+    xs, ys = df[x].to_numpy(dtype=float), df[y].to_numpy(dtype=float)
+    bucket = (len(df) - 2) / (n_out - 2)
+    keep, a = [0], 0
+    for i in range(n_out - 2):
+        start, end = int(i * bucket) + 1, int((i + 1) * bucket) + 1
+        next_end = min(int((i + 2) * bucket) + 1, len(df))
+        avg_x, avg_y = xs[end:next_end].mean(), ys[end:next_end].mean()
+        area = np.abs((xs[a] - avg_x) * (ys[start:end] - ys[a]) - (xs[a] - xs[start:end]) * (avg_y - ys[a]))
+        a = start + int(area.argmax())
+        keep.append(a)
+    keep.append(len(df) - 1)
+    return df.iloc[keep]
+
+# --- LEDGER QUERIES ---
+def build_filters(years, name_q, occ_q, addr_q, quality):
+    where = [f"year IN ({','.join(['?']*len(years))})"]
+    p = list(years)
+    if quality: where.append("is_high_quality = 1")
+    # "^smi" is a surname-prefix search served by idx_name. Otherwise name words are matched
+    # independently so "John Smith" and "Smith John" both hit; anything too short for the
+    # trigram index falls back to a LIKE scan.
+    fts = []  # every indexable term goes into one MATCH so FTS5 intersects the posting lists itself
+    n_terms = name_q.split()
+    if name_q.startswith("^") and name_q[1:].strip():
+        prefix = LIKE_SPECIAL.sub(r"\\\1", name_q[1:].lstrip().lower())
+        where.append("name_search LIKE ? ESCAPE '\\'"); p.append(f"{prefix}%")
+    elif n_terms and all(len(t) >= FTS_MIN_CHARS for t in n_terms):
+        fts += [fts_phrase(["last_name", "first_name"], t) for t in n_terms]
+    elif name_q:
+        where.append("(last_name || ' ' || first_name || ' ' || first_name || ' ' || last_name) LIKE ? COLLATE NOCASE")
+        p.append(f"%{name_q}%")
+    if len(occ_q) >= FTS_MIN_CHARS:
+        fts.append(fts_phrase(["occupation"], occ_q))
+    elif occ_q: where.append("occupation LIKE ? COLLATE NOCASE"); p.append(f"%{occ_q}%")
+    if len(addr_q) >= FTS_MIN_CHARS:
+        fts.append(fts_phrase(["business_address", "home_address"], addr_q))
+    elif addr_q: where.append("(business_address || ' ' || home_address) LIKE ? COLLATE NOCASE"); p.append(f"%{addr_q}%")
+    if fts:
+        where.append("rowid IN (SELECT rowid FROM directory_fts WHERE directory_fts MATCH ?)"); p.append(" AND ".join(fts))
+    return where, p
+
+@st.cache_data(ttl=3600, max_entries=64)
+def count_by_year(years, name_q, occ_q, addr_q, quality, timeline):
+    # Every timeline year gets a row (0 when nothing matched) straight from SQLite. The years
+    # arrive as a JSON array because the shared connection is query_only and can't create a temp table.
+    # Without text filters the per-edition totals come from the summary table instead of a scan.
+    if name_q or occ_q or addr_q:
+        where, p = build_filters(years, name_q, occ_q, addr_q, quality)
+        counts_sql = f"SELECT year, COUNT(*) as count FROM directory WHERE {' AND '.join(where)} GROUP BY year"
+    else:
+        counts_sql = f"SELECT year, SUM(cnt) as count FROM directory_year_counts WHERE year IN ({','.join(['?']*len(years))})"
+        if quality: counts_sql += " AND is_high_quality = 1"
+        counts_sql += " GROUP BY year"
+        p = list(years)
+    sql = f"""
+        SELECT t.value as year, COALESCE(c.count, 0) as count
+        FROM json_each(?) t
+        LEFT JOIN ({counts_sql}) c ON c.year = t.value
+        ORDER BY t.value
+    """
+    return query_df(sql, [json.dumps(timeline)] + p)
+
+@st.cache_data(ttl=3600, max_entries=64)
+def fetch_page(years, name_q, occ_q, addr_q, quality, cursor=None):
+    where, p = build_filters(years, name_q, occ_q, addr_q, quality)
+    if cursor is not None:
+        where.append("sort_key > ?"); p.append(cursor)
+    sql_data = f"""
+        SELECT year, first_name || ' ' || last_name as Name, occupation, display_address as Address,
+               business_address as 'Business Address', publisher, printed_page, sort_key
+        FROM directory WHERE {" AND ".join(where)}
+        ORDER BY year ASC, sort_key ASC LIMIT {PAGE_SIZE}
+    """
+    # Arrow-backed columns skip a Python object per cell and are what st.dataframe serialises to anyway
+    df = pd.read_sql_query(sql_data, get_db_connection(), params=p, dtype_backend="pyarrow")
+    return df
+
+# --- ANALYTICS QUERIES ---
+# The data is static between builds, so each chart's query is memoised on its own inputs;
+# changing one year picker no longer re-runs every other chart's SQL.
+@st.cache_data(ttl=3600)
+def load_growth():
+    return query_df("SELECT year, SUM(cnt) as Count FROM directory_year_counts GROUP BY year ORDER BY year")
+
+# Each per-(year, trade) table is loaded once and both its charts slice it in memory:
+# the top 15 for the picked year, and the #1 entry (ties kept) for every year.
+@st.cache_data(ttl=3600)
+def load_occupation_counts():
+    # Trades are already TRIM/UPPER-merged in occ_year_counts
+    return query_df("SELECT year, Trade, Count FROM occ_year_counts WHERE is_high_quality = 1 AND is_widow = 0")
+
+@st.cache_data(ttl=3600)
+def load_street_counts():
+    return query_df("SELECT year, Street, Count FROM street_year_counts")
+
+def top_for_year(counts, year, n=15):
+    return counts[counts['year'] == year].nlargest(n, 'Count')
+
+def top_per_year(counts):
+    # A per-year MAX join instead of ranking every (year, entry) row; ties still all come through
+    return counts[counts['Count'] == counts.groupby('year')['Count'].transform('max')].sort_values('year')
+
+@st.cache_data(ttl=3600, max_entries=64)
+def load_trade_map(year, trade_q):
+    # Grouped inside SQLite straight off the covering idx_occ_norm; pulling the slice into pandas
+    # for value_counts() timed about 2x slower, since every row still crosses into Python first
+    return query_df("""
+        SELECT street_norm as Street, COUNT(*) as Count
+        FROM directory
+        WHERE year = ? AND instr(occupation_norm, ?) > 0 AND street_norm != 'ZZZZZ'
+        GROUP BY street_norm ORDER BY Count DESC LIMIT 15
+    """, (year, trade_q.upper().strip()))
 
 @st.cache_data
 def get_valid_years(threshold=1000):
     try:
-        conn = get_db_connection()
-        sql = "SELECT year FROM directory GROUP BY year HAVING COUNT(*) >= ? ORDER BY year ASC"
-        df_years = pd.read_sql(sql, conn, params=(threshold,))
-        conn.close()
+        sql = "SELECT year FROM directory_year_counts GROUP BY year HAVING SUM(cnt) >= ? ORDER BY year ASC"
+        df_years = query_df(sql, (threshold,))
         return [int(y) for y in df_years['year'].tolist()]
     except: return []
 
+migrate_db()
 available_years = get_valid_years(threshold=1000)
 
 if not available_years:
@@ -65,86 +389,84 @@ if page == "Search Ledger":
     params = st.query_params
     if "year_selector" not in st.session_state:
         st.session_state["year_selector"] = available_years
+        # Seed with what the URL already says so the default year list alone doesn't rewrite it
+        st.session_state["_last_params"] = {"name": params.get("name", ""), "occupation": params.get("occupation", ""),
+                                            "address": params.get("address", ""), "years": ",".join(str(y) for y in available_years)}
 
-    # 1. Search Filters
-    col1, col2, col3 = st.columns(3)
-    with col1: n_q = st.text_input("Filter by Name", value=params.get("name", ""), placeholder="First or Last...")
-    with col2: o_q = st.text_input("Filter by Occupation", value=params.get("occupation", ""), placeholder="Trade or job...")
-    with col3: a_q = st.text_input("Filter by Address", value=params.get("address", ""), placeholder="Street or Number...")
+    def set_years(years):
+        st.session_state["year_selector"] = years
 
-    # 2. Year Selection (Always Expanded)
-    st.write("### 📅 Select Years")
-    c1, c2, _ = st.columns([1, 1, 6])
-    if c1.button("Select All"): 
-        st.session_state["year_selector"] = available_years
-        st.rerun()
-    if c2.button("Deselect All"): 
-        st.session_state["year_selector"] = []
-        st.rerun()
-    
-    final_years = st.multiselect("Include editions:", available_years, key="year_selector", label_visibility="collapsed")
-    qual_tgl = st.checkbox("✨ High-Quality View Only", value=True)
+    # Filters live in a form so typing doesn't rerun the queries on every keystroke
+    with st.form("filters"):
+        # 1. Search Filters
+        col1, col2, col3 = st.columns(3)
+        with col1: n_q = st.text_input("Filter by Name", value=params.get("name", ""), placeholder="First or Last... (^ for surname prefix)")
+        with col2: o_q = st.text_input("Filter by Occupation", value=params.get("occupation", ""), placeholder="Trade or job...")
+        with col3: a_q = st.text_input("Filter by Address", value=params.get("address", ""), placeholder="Street or Number...")
+
+        # 2. Year Selection (Always Expanded)
+        st.write("### 📅 Select Years")
+        c1, c2, _ = st.columns([1, 1, 6])
+        c1.form_submit_button("Select All", on_click=set_years, args=(available_years,))
+        c2.form_submit_button("Deselect All", on_click=set_years, args=([],))
 
-    st.query_params.update({"name": n_q, "occupation": o_q, "address": a_q, "years": [str(y) for y in final_years]})
+        final_years = st.multiselect("Include editions:", available_years, key="year_selector", label_visibility="collapsed")
+        qual_tgl = st.checkbox("✨ High-Quality View Only", value=True)
+        st.form_submit_button("🔍 Search", type="primary")
+
+    # Only touch the URL when a value actually changed; each write can trigger another rerun
+    new_params = {"name": n_q, "occupation": o_q, "address": a_q, "years": ",".join(str(y) for y in final_years)}
+    if st.session_state.get("_last_params") != new_params:
+        st.query_params.update(new_params)
+        st.session_state["_last_params"] = new_params
 
     if not final_years:
         st.info("Select years above to display the ledger.")
         st.stop()
 
     # 3. Data Processing
-    conn = get_db_connection()
-    where = [f"year IN ({','.join(['?']*len(final_years))})"]
-    p = list(final_years)
-    if qual_tgl: where.append("is_high_quality = 1")
-    if n_q: 
-        where.append("(last_name || ' ' || first_name || ' ' || first_name || ' ' || last_name) LIKE ? COLLATE NOCASE")
-        p.append(f"%{n_q}%")
-    if o_q: where.append("occupation LIKE ? COLLATE NOCASE"); p.append(f"%{o_q}%")
-    if a_q: where.append("(business_address || ' ' || home_address) LIKE ? COLLATE NOCASE"); p.append(f"%{a_q}%")
-
-    where_sql = " WHERE " + " AND ".join(where)
+    years_key = tuple(final_years)
 
     # --- 📈 SEARCH DENSITY CHART ---
     st.write("### 📈 Search Result Density")
-    chart_sql = f"SELECT year, COUNT(*) as count FROM directory {where_sql} GROUP BY year"
-    chart_data_raw = pd.read_sql(chart_sql, conn, params=p)
-    full_timeline = pd.DataFrame(available_years, columns=['year'])
-    chart_df = full_timeline.merge(chart_data_raw, on='year', how='left').fillna(0)
+    # The per-year counts double as the record total, so no separate COUNT(*) pass is needed
+    timeline_df = count_by_year(years_key, n_q, o_q, a_q, qual_tgl, tuple(available_years))
+    total_count = int(timeline_df['count'].sum())
+    chart_df = lttb(timeline_df, 'year', 'count')
     
-    line_chart = alt.Chart(chart_df).mark_line(color="#2c3e50", strokeWidth=2.5, point=alt.OverlayMarkDef(color="#2c3e50", size=50)).encode(
-        x=alt.X('year:O', title='Year', axis=alt.Axis(labelAngle=0, grid=True)),
-        y=alt.Y('count:Q', title='Records', scale=alt.Scale(zero=False, padding=10), axis=alt.Axis(grid=True)),
-        tooltip=['year', 'count']
-    ).properties(height=180, width='container').configure_axis(gridColor="#EAEAEA", gridDash=[2, 2], domain=False).configure_view(strokeWidth=0)
-    st.altair_chart(line_chart, use_container_width=True)
+    st.altair_chart(density_chart_template().properties(data=chart_df), use_container_width=True)
 
     # --- 📜 TABLE VIEW ---
-    count_df = pd.read_sql(f"SELECT COUNT(*) as total FROM directory {where_sql}", conn, params=p)
-    total_count = count_df['total'][0]
-    
-    sql_data = f"""
-        SELECT year, first_name || ' ' || last_name as Name, occupation, 
-               CASE WHEN home_address != '' THEN home_address ELSE business_address END as Address,
-               business_address as 'Business Address', publisher, printed_page
-        FROM directory {where_sql}
-        ORDER BY year ASC, street_sort ASC, house_sort ASC, last_name ASC LIMIT 5000
-    """
-    df = pd.read_sql(sql_data, conn, params=p)
-    conn.close()
+    # A new filter set starts again from page one.
+    filter_key = (years_key, n_q, o_q, a_q, qual_tgl)
+    if st.session_state.get("filter_key") != filter_key:
+        st.session_state.update({"filter_key": filter_key, "cursor": None, "page_no": 1})
+    df = fetch_page(*filter_key, st.session_state["cursor"])
 
     st.write(f"### Records Found: {total_count:,}")
     if not df.empty:
-        df['year'] = df['year'].astype(str)
-        st.dataframe(df, use_container_width=True, hide_index=True, height=500)
+        first_row = (st.session_state["page_no"] - 1) * PAGE_SIZE + 1
+        st.caption(f"Page {st.session_state['page_no']} · rows {first_row:,}–{first_row + len(df) - 1:,}")
+        last_key = int(df["sort_key"].iloc[-1])
+        df = df.drop(columns="sort_key")
+        st.dataframe(df, use_container_width=True, hide_index=True, height=500,
+                     column_config={"year": st.column_config.NumberColumn(format="%d")})
+
+    b1, b2, _ = st.columns([1, 1, 6])
+    if b1.button("⏮ First Page", disabled=st.session_state["page_no"] == 1):
+        st.session_state.update({"cursor": None, "page_no": 1})
+        st.rerun()
+    if b2.button("Next Page ▶", disabled=len(df) < PAGE_SIZE):
+        st.session_state.update({"cursor": last_key, "page_no": st.session_state["page_no"] + 1})
+        st.rerun()
 
 # --- PAGE 2: ANALYTICS ---
 elif page == "Historical Analytics":
     st.title("📈 Historical Analytics & Trends")
-    conn = get_db_connection()
 
     # SECTION 1: Total Volume
     st.write("### 📏 Total Database Volume")
-    growth_df = pd.read_sql("SELECT year, COUNT(*) as Count FROM directory GROUP BY year ORDER BY year", conn)
+    growth_df = load_growth()
     st.altair_chart(alt.Chart(growth_df).mark_area(line={'color':'#2c3e50'}, color=alt.Gradient(gradient='linear', stops=[alt.GradientStop(color='white', offset=0), alt.GradientStop(color='#2c3e50', offset=1)], x1=1, x2=1, y1=1, y2=0)).encode(x='year:O', y='Count:Q', tooltip=['year', 'Count']).properties(height=150), use_container_width=True)
 
     # SECTION 2: OCCUPATIONS (Cleaned aggregation to prevent double bars)
@@ -153,13 +475,7 @@ elif page == "Historical Analytics":
     with col1:
         st.write("### 🎩 Top Occupations (Excl. Widow)")
         occ_year = st.selectbox("Select Year", available_years)
-        # Use TRIM and UPPER to merge similar entries in DB
-        occ_df = pd.read_sql("""
-            SELECT UPPER(TRIM(occupation)) as Trade, COUNT(*) as Count 
-            FROM directory 
-            WHERE year = ? AND occupation != '' AND occupation NOT LIKE '%widow%' AND is_high_quality = 1 
-            GROUP BY Trade ORDER BY Count DESC LIMIT 15
-        """, conn, params=(occ_year,))
+        occ_df = top_for_year(load_occupation_counts(), occ_year)
         # Use aggregate='sum' in Altair for 100% safety
         st.altair_chart(alt.Chart(occ_df).mark_bar(color="#8e44ad").encode(
             x=alt.X('sum(Count):Q', title="Total Count"), 
@@ -169,16 +485,7 @@ elif page == "Historical Analytics":
 
     with col2:
         st.write("### 🏆 #1 Top Job Evolution")
-        occ_evo_sql = """
-            WITH Ranked AS (
-                SELECT year, UPPER(TRIM(occupation)) as Trade, COUNT(*) as Count, 
-                RANK() OVER (PARTITION BY year ORDER BY COUNT(*) DESC) as rnk 
-                FROM directory 
-                WHERE occupation != '' AND occupation NOT LIKE '%widow%' AND is_high_quality = 1 
-                GROUP BY year, Trade
-            ) SELECT year, Trade, Count FROM Ranked WHERE rnk = 1 ORDER BY year
-        """
-        occ_evo_df = pd.read_sql(occ_evo_sql, conn)
+        occ_evo_df = top_per_year(load_occupation_counts())
         occ_line = alt.Chart(occ_evo_df).mark_line(color="#8e44ad", strokeWidth=3).encode(x='year:O', y=alt.Y('Count:Q', scale=alt.Scale(zero=False)))
         st.altair_chart(occ_line + occ_line.mark_text(align='left', dx=5, dy=-5).encode(text='Trade:N'), use_container_width=True)
 
@@ -188,12 +495,7 @@ elif page == "Historical Analytics":
     with col_a:
         st.write("### 🏙️ Busiest Streets")
         street_year = st.selectbox("Select Year", available_years, key="s_y")
-        street_df = pd.read_sql("""
-            SELECT UPPER(TRIM(street_sort)) as Street, COUNT(*) as Count 
-            FROM directory 
-            WHERE year = ? AND street_sort != 'zzzzz' 
-            GROUP BY Street ORDER BY Count DESC LIMIT 15
-        """, conn, params=(street_year,))
+        street_df = top_for_year(load_street_counts(), street_year)
         st.altair_chart(alt.Chart(street_df).mark_bar(color="#27ae60").encode(
             x=alt.X('sum(Count):Q', title="Residents"), 
             y=alt.Y('Street:N', sort='-x'), 
@@ -202,16 +504,7 @@ elif page == "Historical Analytics":
 
     with col_b:
         st.write("### 🏆 #1 Busiest Street Evolution")
-        evo_sql = """
-            WITH Ranked AS (
-                SELECT year, UPPER(TRIM(street_sort)) as Street, COUNT(*) as Count, 
-                RANK() OVER (PARTITION BY year ORDER BY COUNT(*) DESC) as rnk 
-                FROM directory 
-                WHERE street_sort != 'zzzzz' 
-                GROUP BY year, Street
-            ) SELECT year, Street, Count FROM Ranked WHERE rnk = 1 ORDER BY year
-        """
-        evo_df = pd.read_sql(evo_sql, conn)
+        evo_df = top_per_year(load_street_counts())
         evo_line = alt.Chart(evo_df).mark_line(color="#c0392b", strokeWidth=3).encode(x='year:O', y=alt.Y('Count:Q', scale=alt.Scale(zero=False)))
         st.altair_chart(evo_line + evo_line.mark_text(align='left', dx=5, dy=-5).encode(text='Street:N'), use_container_width=True)
 
@@ -221,17 +514,10 @@ elif page == "Historical Analytics":
     c1, c2 = st.columns(2)
     with c1: trade_q = st.text_input("Enter Profession to Map", "Merchant")
     with c2: map_year = st.selectbox("Select Year", available_years, key="m_y")
-    map_df = pd.read_sql("""
-        SELECT UPPER(TRIM(street_sort)) as Street, COUNT(*) as Count 
-        FROM directory 
-        WHERE year = ? AND occupation LIKE ? AND street_sort != 'zzzzz' 
-        GROUP BY Street ORDER BY Count DESC LIMIT 15
-    """, conn, params=(map_year, f"%{trade_q}%"))
+    map_df = load_trade_map(map_year, trade_q)
     if not map_df.empty:
         st.altair_chart(alt.Chart(map_df).mark_bar(color="#e67e22").encode(
             y=alt.Y('Street:N', sort='-x'), 
             x=alt.X('sum(Count):Q'), 
             tooltip=['Street', 'sum(Count)']
         ).properties(height=400), use_container_width=True)
-    
-    conn.close()
\ No newline at end of file